@@ -1,24 +1,50 @@
 #!/usr/bin/env python3
 import serial
 import time
-import csv
 import os
 import glob
-from datetime import datetime
+import math
 import argparse
+import logging
+import queue
+import signal
+import threading
+
+log = logging.getLogger("lora")
+
+# Cache of the formatted timestamp, refreshed at most once per wall-clock second.
+_ts_cache = [0, ""]
+
+# Lines buffered between the serial reader thread and the logging loop.
+SERIAL_QUEUE_SIZE = 1024
+
+# Buffered CSV rows are flushed after this many rows or seconds, whichever comes first.
+FLUSH_ROWS = 16
+FLUSH_INTERVAL = 5.0
+
+# How often the main loop rechecks the shutdown flag while no lines arrive.
+SHUTDOWN_POLL = 1.0
+
+# Most lines handled per batch before pending rows are written out.
+BATCH_LINES = 32
 
 CSV_HEADERS = ["Timestamp", "Event", "MessageNumber", "Distance(m)", "Received", "Lost", "RSSI", "SNR", "TotalPackets", "LossRate"]
 
+# Fields are numbers, a fixed-format timestamp or short tags with no commas or quotes,
+# so rows skip the csv module's quoting. Uses the same line ending csv.writer did.
+ROW_FMT = "{},{},{},{},{},{},{},{},{},{}\r\n"
+HEADER_B = (",".join(CSV_HEADERS) + "\r\n").encode()
+
 def find_serial_port():
     acm_ports = glob.glob('/dev/ttyACM*')
     if acm_ports:
-        print("Found ACM ports:", ", ".join(acm_ports))
+        log.info("Found ACM ports: %s", ", ".join(acm_ports))
         return acm_ports[0]
     usb_ports = glob.glob('/dev/ttyUSB*')
     if usb_ports:
-        print("Found USB ports:", ", ".join(usb_ports))
+        log.info("Found USB ports: %s", ", ".join(usb_ports))
         return usb_ports[0]
-    print("No serial ports found. Retrying...")
+    log.info("No serial ports found. Retrying...")
     return None
 
 def continuously_check_for_port(timeout=60):
@@ -30,70 +56,207 @@ def continuously_check_for_port(timeout=60):
         time.sleep(5)
     return None
 
+def serial_reader(ser, q):
+    # Runs on its own thread so draining the UART never waits on CSV writes.
+    # Reads whatever has arrived (blocking for at least one byte while idle) and
+    # splits lines here, instead of readline()'s one read(1) call per byte.
+    buf = b""
+    while True:
+        try:
+            buf += ser.read(ser.in_waiting or 1)
+            *lines, buf = buf.split(b"\n")
+            for raw in lines:
+                if raw:
+                    q.put(raw)
+        except Exception as e:
+            if not ser.is_open:
+                # The port was closed during shutdown.
+                return
+            log.error("Error reading from serial: %s", e)
+            time.sleep(1)
+
+def now_str():
+    # Rows only need 1-second resolution, so reuse the formatted string within the same second.
+    t = int(time.time())
+    if t != _ts_cache[0]:
+        _ts_cache[0] = t
+        _ts_cache[1] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t))
+    return _ts_cache[1]
+
 def process_data_line(line):
     # Expected CSV format from the receiver:
     # DATA,[boardTimestamp],[MessageNumber],[Distance(m)],[Received],[Lost],[RSSI],[SNR],[TotalPackets],[LossRate]
-    parts = line.split(",")
+    # Returns (row, distance) with the row in CSV_HEADERS order and the distance
+    # already converted, or None if the line can't be used.
+    # Split fully so any extra trailing fields are dropped rather than carried into LossRate.
+    parts = line.rstrip().split(",")
     if len(parts) < 10:
-        print("Incomplete DATA line received:", line)
+        log.warning("Incomplete DATA line received: %s", line)
         return None
     try:
-        data = {
-            "Timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "Event": "DATA",
-            "MessageNumber": parts[2],
-            "Distance(m)": parts[3],
-            "Received": parts[4],
-            "Lost": parts[5],
-            "RSSI": parts[6],
-            "SNR": parts[7],
-            "TotalPackets": parts[8],
-            "LossRate": parts[9].strip()  # remove newline if any
-        }
-        # If TotalPackets is "0", use Received value instead.
-        if data["TotalPackets"].strip() == "0":
-            data["TotalPackets"] = data["Received"]
-        return data
-    except Exception as e:
-        print("Error processing DATA line:", e)
+        distance = float(parts[3])
+    except ValueError as e:
+        log.warning("Error converting distance to float: %s", e)
+        return None
+    # The board prints "nan"/"inf" for bad readings; float() accepts them but they can't be tracked.
+    if not math.isfinite(distance):
+        log.warning("Error converting distance to float: non-finite value %r", parts[3])
         return None
+    # If TotalPackets is "0", use Received value instead.
+    total = parts[4] if parts[8] == "0" else parts[8]
+    row = (now_str(), "DATA", parts[2], parts[3], parts[4], parts[5], parts[6], parts[7], total, parts[9])
+    return row, distance
 
 def process_lost_line(line):
     # Expected format: "LOST: Packet <number>"
     # We'll extract the lost packet number and output a row indicating a lost event.
-    try:
-        parts = line.split()
-        # Parts example: ["LOST:", "Packet", "9"]
-        lost_packet = parts[-1]
-        data = {
-            "Timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "Event": "LOST",
-            "MessageNumber": lost_packet,  # mark which packet was lost
-            "Distance(m)": "",   # you might fill these later if needed
-            "Received": "",
-            "Lost": "",
-            "RSSI": "",
-            "SNR": "",
-            "TotalPackets": "",
-            "LossRate": ""
-        }
-        return data
-    except Exception as e:
-        print("Error processing LOST line:", e)
+    # The packet number is the last space-separated token.
+    _, _, lost_packet = line.rpartition(" ")
+    if not lost_packet.isdigit():
+        log.warning("Malformed LOST line received: %s", line)
         return None
+    # Only the lost packet number is known; the remaining columns stay empty.
+    return (now_str(), "LOST", lost_packet, "", "", "", "", "", "", "")
+
+class CsvSink:
+    # Keeps one open handle per log file so rows don't pay an open/stat per line.
+    def __init__(self, path, flush_every=False):
+        self.path = path
+        self.flush_every = flush_every
+        # Checked once here; afterwards rows only look at the flag, never the filesystem.
+        self.header_written = os.path.getsize(path) > 0 if os.path.exists(path) else False
+        # Binary mode: rows are encoded once and skip the TextIOWrapper encoder.
+        self.fh = open(path, "ab", buffering=8192)
+        self.pending = []
+        self.rows_since_flush = 0
+        self.last_flush = time.monotonic()
+
+    def write_row(self, row):
+        # Rows are queued and written together by write_pending() once per batch.
+        # Write headers only when the file is new (or empty).
+        if not self.header_written:
+            self.pending.append(HEADER_B)
+            self.header_written = True
+        self.pending.append(ROW_FMT.format(*row).encode())
+        self.rows_since_flush += 1
+
+    def write_pending(self):
+        if self.pending:
+            # Drop the batch even if the write fails, so a partial write isn't repeated.
+            try:
+                self.fh.writelines(self.pending)
+            finally:
+                self.pending.clear()
+        # Flush in batches unless per-row flushing was requested.
+        if self.rows_since_flush and (self.flush_every or self.rows_since_flush >= FLUSH_ROWS
+                or time.monotonic() - self.last_flush > FLUSH_INTERVAL):
+            self.fh.flush()
+            self.rows_since_flush = 0
+            self.last_flush = time.monotonic()
 
-def log_data(data, csv_log):
-    # Log the data to CSV. We'll open the file in append mode and write headers if the file doesn't exist.
-    file_exists = os.path.isfile(csv_log)
+    def close(self):
+        if self.fh and not self.fh.closed:
+            try:
+                self.write_pending()
+                # Make sure buffered rows reach the SD card before the file is closed.
+                self.fh.flush()
+                os.fsync(self.fh.fileno())
+            finally:
+                self.fh.close()
+
+def log_data(data, sink):
+    # Log the data to the CSV file held open by the sink.
     try:
-        with open(csv_log, "a", newline="") as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=CSV_HEADERS)
-            if not file_exists:
-                writer.writeheader()
-            writer.writerow(data)
-        print("Logged data:", data)
+        sink.write_row(data)
+        # The row repr is comparatively expensive; only build it when debugging.
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Logged data: %s", data)
     except Exception as e:
-        print("Error writing to CSV:", e)
+        log.error("Error writing to CSV: %s", e)
+
+def _new_log_path(log_dir, distance):
+    # One log file per distance session, stamped with the time it was created.
+    return os.path.join(log_dir, f"lora_data_{distance:.2f}m_{time.strftime('%Y-%m-%d_%H-%M-%S')}.csv")
+
+class LogState:
+    # Session state shared by the line handlers.
+    def __init__(self, log_dir, flush_every=False):
+        self.log_dir = log_dir
+        self.flush_every = flush_every
+        self.current_csv_log = None
+        self.sink = None
+        self.last_cm = None           # Will store the last valid distance, in centimeters
+        self.prev_row = None          # Will store the last row logged with a valid distance
+
+def handle_lost(line, state):
+    lost_data = process_lost_line(line)
+    if lost_data is None:
+        return
+    if state.sink:
+        log_data(lost_data, state.sink)
+    else:
+        log.info("No CSV log file created yet; LOST event not logged to CSV.")
+
+def handle_data(line, state):
+    parsed = process_data_line(line)
+    if parsed is None:
+        return
+    data, current_distance = parsed
+    # Compare distances as whole centimeters so float noise can't start a new file.
+    cur_cm = round(current_distance * 100)
+
+    # If a transient or malformed distance is detected (0.00 while last valid distance > 0),
+    # continue logging in the current session and override Lost with the last valid value.
+    if state.last_cm and cur_cm == 0 and state.prev_row:
+        log.debug("Transient 0.00 value detected, using last valid Lost count: %s", state.prev_row[5])
+        data = data[:5] + (state.prev_row[5],) + data[6:]
+    else:
+        # Valid distance reading; remember it for later transient rows.
+        state.prev_row = data
+
+    # Create a new log file only if:
+    # 1) No file exists yet or
+    # 2) A new session is detected with a higher (and valid) distance.
+    # Lower or equal distances keep logging to the current file.
+    if state.last_cm is None or cur_cm > state.last_cm:
+        first = state.last_cm is None
+        state.last_cm = cur_cm
+        state.current_csv_log = _new_log_path(state.log_dir, current_distance)
+        if first:
+            log.info("New session detected: New distance (%.2f m). Creating log file: %s", current_distance, state.current_csv_log)
+        else:
+            log.info("New distance detected (%.2f m). Creating new log file: %s", current_distance, state.current_csv_log)
+    elif cur_cm < state.last_cm:
+        log.debug("Transient or lower value detected (Current: %.2f m, Last: %.2f m). Continuing to log data in file for %.2f m", current_distance, state.last_cm / 100, state.last_cm / 100)
+
+    if state.current_csv_log and (state.sink is None or state.sink.path != state.current_csv_log):
+        # Rotate: close the previous file before opening the new one. The old sink is
+        # detached first so a failed close or open can't leave rows going to a closed file.
+        old_sink, state.sink = state.sink, None
+        if old_sink:
+            old_sink.close()
+        state.sink = CsvSink(state.current_csv_log, state.flush_every)
+
+    if state.sink:
+        log_data(data, state.sink)
+
+def handle_line(raw, state):
+    # Ignore "Large gap detected" lines before paying for a decode; they don't update the Lost count.
+    if raw.startswith(b"Large gap"):
+        log.debug("Ignoring large gap message; not updating Lost count.")
+        return
+    line = raw.decode('utf-8', errors='replace').strip()
+    if line:
+        log.debug("RAW: %s", line)
+        handler = HANDLERS.get(line[:5])
+        if handler:
+            handler(line, state)
+
+# Line handlers keyed on the 5-character prefix of each line.
+HANDLERS = {
+    "DATA,": handle_data,
+    "LOST:": handle_lost,
+}
 
 def main():
     parser = argparse.ArgumentParser(description='LoRa Data Logger for DomH-giti')
@@ -101,110 +264,103 @@ def main():
     parser.add_argument('--baud', type=int, default=115200, help='Baud rate')
     parser.add_argument('--log-dir', default=os.path.expanduser("~/lora_data_logs"), help='Directory for logs')
     parser.add_argument('--wait-for-port', type=int, default=60, help='Seconds to wait for serial port')
+    parser.add_argument('--flush-every', action='store_true', help='Flush the CSV file after every row (safer on power loss, slower)')
+    parser.add_argument('--quiet', action='store_true', help='Only show warnings and errors')
+    parser.add_argument('--verbose', action='store_true', help='Also show every raw line and logged row')
     args = parser.parse_args()
+
+    level = logging.WARNING if args.quiet else logging.DEBUG if args.verbose else logging.INFO
+    logging.basicConfig(level=level, format="%(asctime)s %(levelname)s: %(message)s")
     
-    # Setup log directory
-    log_dir = args.log_dir
+    # Setup log directory. It is resolved and created once here; rotation assumes it
+    # still exists and opens files under the resolved path without further checks.
+    log_dir = os.path.realpath(os.path.expanduser(args.log_dir))
     os.makedirs(log_dir, exist_ok=True)
     
-    current_csv_log = None
-    last_distance = None     # Will store the last valid float distance
-    last_lost = None         # Will store the last valid lost packets count
+    state = LogState(log_dir, args.flush_every)
 
-    print("Using log directory:", log_dir)
+    log.info("Using log directory: %s", log_dir)
     port = args.port
     if not port:
-        print("Auto-detecting serial port...")
+        log.info("Auto-detecting serial port...")
         port = continuously_check_for_port(args.wait_for_port)
     if not port:
-        print("ERROR: Could not find a serial port.")
+        log.error("Could not find a serial port.")
         return
     
-    print("Serial port:", port)
+    log.info("Serial port: %s", port)
     
     try:
-        ser = serial.Serial(port, args.baud, timeout=1)
+        # No timeout: the reader thread's readline() blocks until a newline arrives
+        # instead of polling, so it uses no CPU while the link is idle.
+        ser = serial.Serial(port, args.baud, timeout=None)
         # Flush any preexisting data
         ser.reset_input_buffer()
     except Exception as e:
-        print("Failed to open serial port:", e)
+        log.error("Failed to open serial port: %s", e)
         return
     
-    print("Serial connection established on", port)
-    print("Waiting for data... (Press Ctrl+C to stop)")
+    log.info("Serial connection established on %s", port)
+    log.info("Waiting for data... (Press Ctrl+C to stop)")
     
-    while True:
+    # Ctrl+C and SIGTERM only clear this flag; the loop then exits and the finally
+    # block flushes and fsyncs the current log before the process ends.
+    running = [True]
+    signal.signal(signal.SIGINT, lambda *_: running.__setitem__(0, False))
+    signal.signal(signal.SIGTERM, lambda *_: running.__setitem__(0, False))
+
+    q = queue.Queue(maxsize=SERIAL_QUEUE_SIZE)
+    threading.Thread(target=serial_reader, args=(ser, q), daemon=True).start()
+
+    try:
+        while running[0]:
+            try:
+                # Wait for the next line read by the serial thread, then take whatever
+                # else has already arrived so a burst is written to disk in one go.
+                # The timeout lets the loop notice a shutdown request and still
+                # flush buffered rows on the FLUSH_INTERVAL while the link is quiet.
+                try:
+                    batch = [q.get(timeout=SHUTDOWN_POLL)]
+                except queue.Empty:
+                    if state.sink:
+                        state.sink.write_pending()
+                    continue
+                backlog = q.qsize()
+                if backlog > SERIAL_QUEUE_SIZE // 2:
+                    log.warning("Serial queue backlog: %d lines waiting", backlog)
+                while len(batch) < BATCH_LINES:
+                    try:
+                        batch.append(q.get_nowait())
+                    except queue.Empty:
+                        break
+                for raw in batch:
+                    try:
+                        handle_line(raw, state)
+                    except Exception as e:
+                        log.error("Error processing serial line: %s", e)
+                if state.sink:
+                    state.sink.write_pending()
+            except Exception as e:
+                log.error("Error writing to CSV: %s", e)
+        log.info("Exiting...")
+    finally:
+        # Lines already queued by the reader were accepted; log them before closing the file.
+        while True:
+            try:
+                raw = q.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                handle_line(raw, state)
+            except Exception as e:
+                log.error("Error processing serial line: %s", e)
         try:
-            if ser.in_waiting:
-                # Read the next line from the serial port
-                line = ser.readline().decode('utf-8', errors='replace').strip()
-                if line:
-                    print("RAW:", line)
-                    
-                    # Ignore "Large gap detected" lines; they don't update the Lost count.
-                    if line.startswith("Large gap detected"):
-                        print("Ignoring large gap message; not updating Lost count.")
-                        continue
-                    
-                    # Process lost packet lines
-                    if line.startswith("LOST:"):
-                        lost_data = process_lost_line(line)
-                        if lost_data and current_csv_log:
-                            log_data(lost_data, current_csv_log)
-                        else:
-                            print("No CSV log file created yet; LOST event not logged to CSV.")
-                        continue
-
-                    # Process DATA lines as before
-                    if line.startswith("DATA,"):
-                        data = process_data_line(line)
-                        if data is None:
-                            continue
-                        try:
-                            current_distance = float(data["Distance(m)"])
-                        except Exception as e:
-                            print("Error converting distance to float:", e)
-                            continue
-                        
-                        # If a transient or malformed distance is detected (0.00 while last valid distance > 0),
-                        # continue logging in the current session and override Lost with the last valid value.
-                        if last_distance is not None and current_distance == 0.0 and last_distance != 0.0:
-                            print(f"Transient 0.00 value detected, using last valid Lost count: {last_lost if last_lost is not None else 0}")
-                            data["Lost"] = str(last_lost if last_lost is not None else 0)
-                        else:
-                            # Valid distance reading; update last_lost and last_distance if needed.
-                            try:
-                                current_lost = int(float(data["Lost"]))
-                            except Exception:
-                                current_lost = 0
-                            last_lost = current_lost
-                        
-                        # Create a new log file only if:
-                        # 1) No file exists yet or
-                        # 2) A new session is detected with a higher (and valid) distance.
-                        if last_distance is None:
-                            last_distance = current_distance
-                            timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-                            current_csv_log = os.path.join(log_dir, f"lora_data_{current_distance:.2f}m_{timestamp}.csv")
-                            print(f"New session detected: New distance ({current_distance:.2f} m). Creating log file: {current_csv_log}")
-                        elif current_distance <= last_distance and current_distance != last_distance:
-                            print(f"Transient or lower value detected (Current: {current_distance:.2f} m, Last: {last_distance:.2f} m). Continuing to log data in file for {last_distance:.2f} m")
-                        elif current_distance > last_distance:
-                            last_distance = current_distance
-                            timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-                            current_csv_log = os.path.join(log_dir, f"lora_data_{current_distance:.2f}m_{timestamp}.csv")
-                            print(f"New distance detected ({current_distance:.2f} m). Creating new log file: {current_csv_log}")
-                            
-                        if current_csv_log:
-                            log_data(data, current_csv_log)
-            else:
-                time.sleep(0.1)
-        except KeyboardInterrupt:
-            print("Exiting...")
-            break
+            if state.sink:
+                state.sink.close()
         except Exception as e:
-            print("Error reading from serial:", e)
-            time.sleep(1)
+            log.error("Error closing CSV log: %s", e)
+        finally:
+            ser.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file